@@ -1,4 +1,7 @@
 # Django model
+_CANCEL_BLOCKING_STATUSES = frozenset((Delivery.STATUSES.FACT, Delivery.STATUSES.SHIPPED))
+
+
 class Order(TimestampedModel):
     """
     Client create this, when he wants to buy something.
@@ -14,8 +17,8 @@ class Order(TimestampedModel):
         ("DELETED", _("Deleted")),
     )
 
-    STOCK_RESERVED_STATUSES = (STATUSES.CONFIRMED, STATUSES.IN_PROGRESS, STATUSES.PAID)
-    EDITABLE_STATUSES = (STATUSES.DRAFT, STATUSES.RESERVED)
+    STOCK_RESERVED_STATUSES = frozenset((STATUSES.CONFIRMED, STATUSES.IN_PROGRESS, STATUSES.PAID))
+    EDITABLE_STATUSES = frozenset((STATUSES.DRAFT, STATUSES.RESERVED))
 
     organization = ForeignKey(Organization, CASCADE, related_name="orders")
     manager = ForeignKey(User, CASCADE, related_name="orders", null=True)
@@ -29,6 +32,9 @@ class Order(TimestampedModel):
     status_updated_at = MonitorField(monitor="status", blank=True, null=True)
     dereservation_at = DateTimeField(null=True, default=None, editable=False)
 
+    # Денормализованная сумма позиций, поддерживается в OrderItem.save/post_delete
+    total_sum = DecimalField(_("Сумма заказа"), max_digits=28, decimal_places=2, default=0)
+
     transactions = GenericRelation(BatchTransaction, related_query_name="order")
 
     objects = OrderManager()
@@ -48,7 +54,8 @@ class Order(TimestampedModel):
             if update_fields and "status_updated_at" not in update_fields:
                 if not isinstance(update_fields, set):
                     update_fields = set(update_fields)
-                kwargs["update_fields"] = update_fields.union({"status_updated_at"})
+                update_fields.add("status_updated_at")
+                kwargs["update_fields"] = update_fields
         super().save(*args, **kwargs)
 
     @property
@@ -57,15 +64,34 @@ class Order(TimestampedModel):
 
     @property
     def _is_cancelable(self) -> bool:
-        return not self.deliveries.filter(status__in=(Delivery.STATUSES.FACT, Delivery.STATUSES.SHIPPED)).exists()
+        has_blocking_delivery = getattr(self, "_has_blocking_delivery", None)
+        if has_blocking_delivery is not None:
+            return not has_blocking_delivery
+        return not self.deliveries.filter(status__in=_CANCEL_BLOCKING_STATUSES).exists()
 
     @staticmethod
     def get_new_dereservation_time() -> datetime:
         return timezone.now() + timedelta(hours=1)
 
+    def _save_status_only(self, *extra_fields: str) -> None:
+        """
+        Быстрый путь после @transition: один UPDATE без повторного прохода
+        через save() с его FSM-защитой и обработкой update_fields.
+        """
+        updates = {"status": self.status, "status_updated_at": timezone.now()}
+        for field in extra_fields:
+            updates[field] = getattr(self, field)
+        Order.objects.filter(pk=self.pk).update(**updates)
+
+    def _delete_empty_items(self) -> None:
+        # _raw_delete обходит коллектор каскадов и сигналы: у пустых позиций sum == 0,
+        # так что корректировка total_sum здесь не требуется
+        empty_items = OrderItem.objects.filter(order_id=self.id, amount=0)
+        empty_items._raw_delete(empty_items.db)
+
     @transition(status, STATUSES.DRAFT, STATUSES.RESERVED)
     def mark_reserved(self) -> None:
-        self.items.filter(amount=0).delete()
+        self._delete_empty_items()
         self.dereservation_at = self.get_new_dereservation_time()
         self.items.update(status=OrderItem.STATUSES.RESERVE)
 
@@ -79,28 +105,42 @@ class Order(TimestampedModel):
         from foodex.apps.external.tasks import add_deal, ext_dbs_sync_order
         from foodex.apps.logistic.utils import make_batch_items
 
-        self.items.filter(amount=0).delete()
-        for order_item in self.items.all():
+        self._delete_empty_items()
+        order_items = list(self.items.all())
+        for order_item in order_items:
             order_item.update_price_and_vat()
-            order_item.save(update_fields=["price", "vat"])
+            order_item.set_sum()
+            order_item.set_vat_sum()
+        OrderItem.objects.bulk_update(order_items, ["price", "vat", "sum", "vat_sum"], batch_size=500)
+
+        # bulk_update минует OrderItem.save, поэтому обновляем денормализованную сумму сами
+        self.total_sum = sum((order_item.sum for order_item in order_items), Decimal(0))
+        Order.objects.filter(pk=self.id).update(total_sum=self.total_sum)
 
     @transition(status, STATUSES.CONFIRMED, STATUSES.PAID)
     def mark_paid(self) -> None:
         from foodex.apps.external.tasks import add_delivery_paid
 
-        deliveries = self.deliveries.exclude(status=Delivery.STATUSES.CANCELED)
-        deliveries.update(status=Delivery.STATUSES.PAID)
+        delivery_ids = list(
+            self.deliveries.exclude(status=Delivery.STATUSES.CANCELED).values_list("id", flat=True)
+        )
+        if delivery_ids:
+            Delivery.objects.filter(id__in=delivery_ids).update(status=Delivery.STATUSES.PAID)
+            add_delivery_paid.delay(delivery_ids)
 
     @transition(status, (STATUSES.PAID, STATUSES.CONFIRMED, STATUSES.IN_PROGRESS), STATUSES.CANCELED)
     def mark_canceled(self) -> None:
         if not self._is_cancelable:
             raise TransitionNotAllowed("Order is not cancelable.")
 
-        self.transactions.all().delete()
+        BatchTransaction.objects.filter(
+            content_type=ContentType.objects.get_for_model(Order), object_id=self.id
+        ).delete()
 
-        for delivery in self.deliveries.all():
+        deliveries = list(self.deliveries.exclude(status=Delivery.STATUSES.CANCELED).only("id", "status"))
+        for delivery in deliveries:
             delivery.mark_canceled()
-            delivery.save(update_fields=["status"])
+        Delivery.objects.bulk_update(deliveries, ["status"])
 
     @transition(status, (STATUSES.DRAFT, STATUSES.RESERVED), STATUSES.DELETED)
     def mark_deleted(self) -> None:
@@ -145,39 +185,50 @@ class OrderItem(UpdateFieldsMixin, FieldSetterMixin, TimestampedModel):
     def __str__(self) -> str:
         return "{}({}) {}".format(self.offer, self.offer.product, self.amount)
 
-    def save(self, *args: Any, **kwargs: Any) -> None:
+    def save(self, *args: Any, skip_order_touch: bool = False, **kwargs: Any) -> None:
         if self.order.status == Order.STATUSES.RESERVED:
             if not self.id:
                 self.status = self.STATUSES.RESERVE
 
-            if self.order.dereservation_at is not None:
+            if not skip_order_touch and self.order.dereservation_at is not None:
                 self.order.dereservation_at = self.order.get_new_dereservation_time()
                 self.order.save(update_fields=["dereservation_at"])
 
+        order_sum_delta = None
         if self.is_price_changed:
+            old_sum = self.sum or Decimal(0) if self.id else Decimal(0)
             self.set_sum()
             self.add_update_fields.add("sum")
+            order_sum_delta = self.sum - old_sum
             if self.is_vat_changed:
                 self.set_vat_sum()
                 self.add_update_fields.add("vat_sum")
 
         super().save(*args, **kwargs)
 
+        if order_sum_delta:
+            Order.objects.filter(pk=self.order_id).update(total_sum=F("total_sum") + order_sum_delta)
+
+
+@receiver(post_delete, sender=OrderItem)
+def subtract_order_item_sum(sender: type, instance: OrderItem, **kwargs: Any) -> None:
+    if instance.sum:
+        Order.objects.filter(pk=instance.order_id).update(total_sum=F("total_sum") - instance.sum)
+
 
 # Django viewset
+_BLOCKING_DELIVERIES = Delivery.objects.filter(order_id=OuterRef("pk"), status__in=_CANCEL_BLOCKING_STATUSES)
+
+
 class OrderViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, DestroyModelMixin, GenericViewSet):
     """
     Order endpoint
     """
 
     queryset = (
-        Order.objects.annotate(sum=Sum("items__sum"))
-        .select_related("manager")
-        .prefetch_related(
-            "documents",
-            "items",
-            Prefetch("deliveries", Delivery.objects.only("id", "order_id").all()),
-        )
+        Order.objects.annotate(_has_blocking_delivery=Exists(_BLOCKING_DELIVERIES))
+        .select_related("manager", "organization")
+        .prefetch_related("documents")
         .all()
     )
     serializer_class = OrderPageOrderSerializer
@@ -189,7 +240,11 @@ class OrderViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
     def get_queryset(self) -> QuerySet:
         if self.action == "generate_deliveries":
             return Order.objects.filter(status=Order.STATUSES.DRAFT)
-        return super().get_queryset()
+        queryset = super().get_queryset()
+        if self.action in ("retrieve", "update", "partial_update"):
+            # Постранично items нужны только в детальных экшенах, на списке хватает денормализованного total_sum
+            queryset = queryset.prefetch_related("items")
+        return queryset
 
     def get_serializer_class(self, *args: Any, **kwargs: Any) -> type[ModelSerializer]:
         if self.action == "generate_deliveries":
@@ -204,7 +259,7 @@ class OrderViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
         except TransitionNotAllowed as e:
             raise ValidationError(_("Order cannot be deleted.")) from e
 
-        order.save(update_fields=["status"])
+        order._save_status_only()
         logger_info.info("Order has been deleted.", extra={"order_id": order.id})
         return Response(status=HTTP_204_NO_CONTENT)
 
@@ -218,7 +273,7 @@ class OrderViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
         except TransitionNotAllowed as e:
             raise ValidationError(_("Order cannot be canceled.")) from e
         logger_info.info("Order has been canceled.", extra={"order_id": instance.id})
-        instance.save(update_fields=["status"])
+        instance._save_status_only()
 
     @extend_schema(request=None)
     @action(["post"], detail=True)
@@ -242,7 +297,7 @@ class OrderViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
         Order status transfer from DRAFT to RESERVED.
         """
         instance.mark_reserved()
-        instance.save(update_fields=["status", "dereservation_at"])
+        instance._save_status_only("dereservation_at")
 
     @extend_schema(request=None)
     @action(["post"], detail=True)
@@ -253,7 +308,7 @@ class OrderViewSet(CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, Destr
         Order confirmation
         """
         instance.make_confirmed()
-        instance.save(update_fields=["status"])
+        instance._save_status_only()
 
 
 # Djanfo form
@@ -383,10 +438,16 @@ class FreshLogicExporter:
 
     def __init__(self, warehouse: "FreshLogicWarehouse") -> None:
         self.warehouse = warehouse
-    
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4)
+    def _load_template_bytes(path: str) -> bytes:
+        with open(path, "rb") as template:
+            return template.read()
+
     @classmethod
     def export_draft_order(cls, order: Order) -> bytes:
-        xw = XlsxWriter(filename=cls.BASE_DRAFT_ORDER_PATH)
+        xw = XlsxWriter(filename=io.BytesIO(cls._load_template_bytes(cls.BASE_DRAFT_ORDER_PATH)))
 
         xw.write_cell(
             cls.ORDER_DATE_TEXT.format(order.id, order.created_at.strftime("%d.%m.%Y %H:%M")), column=1, row=7
@@ -399,22 +460,45 @@ class FreshLogicExporter:
         xw.next_print_area(from_row=1, size=cls.PAGE_SIZE)
 
         row = cls.TABLE_ROW
-        order_items = OrderItem.objects.select_related("offer").filter(order=order)
-        order_total_price = 0
-        order_total_vat = 0
-        for i, order_item in enumerate(order_items, start=1):
-            product = order_item.offer.product
-            total = order_item.offer.price_for_transport_package * order_item.amount
-            total_vat = Decimal(total / (100 + product.vat)).quantize(Decimal(".01")) * product.vat
-            order_total_price += total
-            order_total_vat += total_vat
+        order_items = (
+            OrderItem.objects.filter(order_id=order.id)
+            .annotate(
+                line_total=ExpressionWrapper(
+                    F("offer__price_for_transport_package") * F("amount"),
+                    output_field=DecimalField(max_digits=28, decimal_places=2),
+                )
+            )
+            .annotate(
+                line_vat=ExpressionWrapper(
+                    F("line_total") * F("offer__product__vat") / (100 + F("offer__product__vat")),
+                    output_field=DecimalField(max_digits=30, decimal_places=4),
+                )
+            )
+        )
+        totals = order_items.aggregate(total_price=Sum("line_total"), total_vat=Sum("line_vat"))
+        order_total_price = totals["total_price"] or 0
+        order_total_vat = totals["total_vat"] or 0
+
+        rows = order_items.values(
+            "amount",
+            "offer__price_for_transport_package",
+            "offer__expired_at",
+            "offer__product__code",
+            "offer__product__title",
+            "line_total",
+        )
+        current_tz = timezone.get_current_timezone()
+        next_page_break = cls.PAGE_SIZE
+        for i, order_item in enumerate(rows.iterator(chunk_size=500), start=1):
+            price = order_item["offer__price_for_transport_package"]
+            total = order_item["line_total"]
 
             xw.write_cell(i, column=1, row=row, align="center", font_size=9, bordered=True)
-            xw.write_cell(product.code, column=2, row=row, align="center", font_size=9, bordered=True)
-            xw.write_cell(product.title, column=3, row=row, align="left", font_size=10, bordered=True)
-            xw.write_cell(float(order_item.amount), column=4, row=row, align="center", font_size=9, bordered=True)
+            xw.write_cell(order_item["offer__product__code"], column=2, row=row, align="center", font_size=9, bordered=True)
+            xw.write_cell(order_item["offer__product__title"], column=3, row=row, align="left", font_size=10, bordered=True)
+            xw.write_cell(float(order_item["amount"]), column=4, row=row, align="center", font_size=9, bordered=True)
             xw.write_cell(
-                float(order_item.offer.price_for_transport_package),
+                float(price),
                 column=5,
                 row=row,
                 align="center",
@@ -430,7 +514,7 @@ class FreshLogicExporter:
                 bordered=True,
             )
             xw.write_cell(
-                localtime(order_item.offer.expired_at).strftime("%d.%m.%Y"),
+                order_item["offer__expired_at"].astimezone(current_tz).strftime("%d.%m.%Y"),
                 column=7,
                 row=row,
                 align="center",
@@ -439,16 +523,14 @@ class FreshLogicExporter:
             )
 
             row += 1
-            if row % cls.PAGE_SIZE == 0:
+            if row == next_page_break:
                 xw.next_print_area(from_row=row + 1, size=cls.PAGE_SIZE)
                 row += 2
+                next_page_break += cls.PAGE_SIZE
 
         after_items = row
-        order_sum = float(Decimal(order_total_price).quantize(Decimal(".001")))
-        order_vat = float(Decimal(order_total_vat).quantize(Decimal(".001")))
-
-        total = divmod(order_sum, 1)
-        total_vat = divmod(order_vat, 1)
+        order_sum = round(float(order_total_price), 2)
+        order_vat = round(float(order_total_vat), 2)
 
         xw.merge_cells(start_row=(after_items + 1), start_column=4, end_column=5)
         xw.merge_cells(start_row=(after_items + 1), start_column=6, end_column=7)
@@ -491,3 +573,19 @@ class FreshLogicExporter:
             xw.next_print_area(from_row=after_items + 2, size=cls.PAGE_SIZE)
 
         return xw.get_buffer()
+
+
+# Django settings
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": env.str("POSTGRES_DB"),
+        "USER": env.str("POSTGRES_USER"),
+        "PASSWORD": env.str("POSTGRES_PASSWORD"),
+        "HOST": env.str("POSTGRES_HOST"),
+        "PORT": env.int("POSTGRES_PORT"),
+        # Переиспользуем соединения воркеров между запросами вместо открытия нового на каждый запрос
+        "CONN_MAX_AGE": 600,
+        "CONN_HEALTH_CHECKS": True,
+    }
+}